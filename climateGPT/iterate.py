@@ -11,6 +11,15 @@ import torch.distributed as dist
 log = structlog.get_logger()
 
 
+def _loader_kwargs(device: str, num_workers: int) -> dict:
+    # keep the workers a few batches ahead of the main loop
+    return dict(
+        num_workers=num_workers,
+        prefetch_factor=4 if num_workers > 0 else None,
+        pin_memory=device.startswith("cuda"),
+    )
+
+
 # create an iterable dataset class to iterate over pre-tokenized data
 class TokenIterator(torch.utils.data.IterableDataset):
     def __init__(
@@ -76,8 +85,9 @@ class TokenIterator(torch.utils.data.IterableDataset):
                     start = ix * self.context_length
                     end = start + self.context_length + 1
                     # calling .astype will copy the data into a new numpy array,
-                    # now in RAM
-                    chunk = torch.from_numpy((m[start:end]).astype(np.int64))
+                    # now in RAM. int32 halves the host to device bytes compared to
+                    # int64 and is enough for uint16 token ids
+                    chunk = torch.from_numpy((m[start:end]).astype(np.int32))
                     x = chunk[:-1]
                     y = chunk[1:]
                     yield x, y
@@ -85,8 +95,10 @@ class TokenIterator(torch.utils.data.IterableDataset):
     @classmethod
     def iter_batches(cls, batch_size, device, num_workers=0, **iterator_kwargs):
         ds = cls(**iterator_kwargs)
+        # a worker without any shard would never yield a batch
+        num_workers = min(num_workers, len(ds.filenames))
         dl = torch.utils.data.DataLoader(
-            ds, batch_size=batch_size, pin_memory=True, num_workers=num_workers
+            ds, batch_size=batch_size, **_loader_kwargs(device, num_workers)
         )
         for x, y in dl:
             x = x.to(device, non_blocking=True)
@@ -140,7 +152,8 @@ class TokenBatches(torch.utils.data.Dataset):
             start_token_idx : start_token_idx + self.context_length + 1
         ]
         # calling .astype will copy the data into a new numpy array, now in RAM
-        chunk = torch.from_numpy(chunk.astype(np.int64))
+        # (int32 is enough for uint16 token ids and halves the transfer size)
+        chunk = torch.from_numpy(chunk.astype(np.int32))
         x = chunk[:-1]
         y = chunk[1:]
 
@@ -152,9 +165,9 @@ class TokenBatches(torch.utils.data.Dataset):
         dl = torch.utils.data.DataLoader(
             ds,
             batch_size=batch_size,
-            pin_memory=True,
-            num_workers=num_workers,
             shuffle=True,
+            drop_last=True,  # keep batch shapes static
+            **_loader_kwargs(device, num_workers)
         )
         for x, y in dl:
             x = x.to(device, non_blocking=True)
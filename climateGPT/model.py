@@ -12,6 +12,11 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+try:
+    import bitsandbytes as bnb  # optional, enables the 8-bit AdamW optimizer
+except ImportError:
+    bnb = None
+
 log = structlog.get_logger()
 
 # model params
@@ -669,8 +674,6 @@ class TransformerBlock(nn.Module):
 
 # Transformer model
 class Transformer(nn.Module):
-    last_loss: Optional[torch.Tensor] = None
-
     def __init__(self, args: ModelArgs) -> None:
         super().__init__()
         self.args = args
@@ -717,7 +720,7 @@ class Transformer(nn.Module):
 
     def forward(
         self, tokens: torch.Tensor, targets: Optional[torch.Tensor] = None
-    ) -> torch.Tensor:
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         _, context_length = tokens.shape
         freqs_cos = self.freqs_cos[:context_length]
         freqs_sin = self.freqs_sin[:context_length]
@@ -738,8 +741,11 @@ class Transformer(nn.Module):
 
         if targets is not None:
             logits = self.output(tokens)
-            self.last_loss = F.cross_entropy(
-                logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1
+            # cross entropy expects int64 targets, the batches come in int32
+            loss = F.cross_entropy(
+                logits.view(-1, logits.size(-1)),
+                targets.view(-1).long(),
+                ignore_index=-1,
             )
         else:
             # inference-time mini-optimization: only forward the output on the very last
@@ -747,9 +753,9 @@ class Transformer(nn.Module):
             logits = self.output(
                 tokens[:, [-1], :]
             )  # note: using list [-1] to preserve the time dim
-            self.last_loss = None
+            loss = None
 
-        return logits
+        return logits, loss
 
     def configure_optimizer(
         self,
@@ -757,6 +763,7 @@ class Transformer(nn.Module):
         weight_decay: float,
         betas: Tuple[float, float],
         device_type: str,
+        use_8bit: bool = False,
     ):
         # start with all candidate parameters
         params = {pn: p for pn, p in self.named_parameters() if p.requires_grad}
@@ -784,15 +791,41 @@ class Transformer(nn.Module):
             Containing {num_nodecay_params:,} parameters
             """
         )
-        # Create AdamW optimizer and use the fused version if it is available
-        fused_available = "fused" in inspect.signature(torch.optim.AdamW).parameters
-        use_fused = fused_available and device_type == "cuda"
-        extra_args = dict(fused=True) if use_fused else dict()
+        # Optionally use the 8-bit AdamW from bitsandbytes on cuda: its block-wise
+        # quantized moments take 4x less memory than the float32 ones
+        if use_8bit:
+            if bnb is None:
+                raise ImportError("8-bit AdamW requires bitsandbytes to be installed")
+            if not device_type.startswith("cuda"):
+                raise ValueError("8-bit AdamW is only supported on cuda devices")
+            # keep float32 optimizer states for the 1D parameters (norm weights).
+            # The overrides are keyed by parameter, registering the groups maps them
+            # to the (group, param) indices the optimizer looks up
+            manager = bnb.optim.GlobalOptimManager.get_instance()
+            manager.override_config(nodecay_params, "optim_bits", 32)
+            manager.register_parameters(optim_groups)
+            optimizer = bnb.optim.AdamW8bit(
+                params=optim_groups, lr=learning_rate, betas=betas
+            )
+            log.info("using 8-bit AdamW from bitsandbytes")
+            return optimizer
+
+        # Create AdamW optimizer and use the fused version if it is available,
+        # otherwise fall back to the multi-tensor (foreach) implementation
+        adamw_parameters = inspect.signature(torch.optim.AdamW).parameters
+        use_fused = "fused" in adamw_parameters and device_type.startswith("cuda")
+        use_foreach = not use_fused and "foreach" in adamw_parameters
+        if use_fused:
+            extra_args = dict(fused=True)
+        elif use_foreach:
+            extra_args = dict(foreach=True)
+        else:
+            extra_args = dict()
         optimizer = torch.optim.AdamW(
             params=optim_groups, lr=learning_rate, betas=betas, **extra_args
         )
 
-        log.info(f"using fused AdamW: {use_fused}")
+        log.info(f"using fused AdamW: {use_fused}, foreach AdamW: {use_foreach}")
 
         return optimizer
 
@@ -841,7 +874,7 @@ class Transformer(nn.Module):
                 else idx[:, -self.args.max_context_length :]
             )
             # forward the model to get the logits for the index in the sequence
-            logits = self(idx_cond)
+            logits, _ = self(idx_cond)
             logits = logits[:, -1, :]  # crop to just the final time step
             if temperature == 0.0:
                 # "sample" the single most likely index
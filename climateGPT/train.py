@@ -1,16 +1,22 @@
-import math
+import atexit
 import os
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import nullcontext
 from dataclasses import dataclass
 from datetime import datetime
 from functools import partial
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import structlog
 import torch
+import torch.distributed as dist
+import torch.utils.checkpoint
 from simple_parsing import ArgumentParser
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim.lr_scheduler import LambdaLR
 
 import wandb
 from climateGPT.export import model_export
@@ -43,9 +49,13 @@ class BatchConfig:
         1  # if gradient_accumulation_steps > 1, this is the micro-batch size
     )
     gradient_accumulation_steps: int = 1  # used to simulate larger batch sizes
-    num_workers: int = 0
+    num_workers: int = min(4, (os.cpu_count() or 1) // 2)
     seed_offset: int = 0
     dataset_class: str = "iterator"  # or "batches"
+    # use the largest micro-batch that fits on the GPU in place of grad accumulation
+    # (cuda only). Only divisors of batch_size * gradient_accumulation_steps are
+    # tried, so this does nothing when gradient_accumulation_steps == 1
+    auto_batch: bool = False
 
 
 @dataclass
@@ -57,6 +67,7 @@ class OptimizerConfig:
     beta1: float = 0.9
     beta2: float = 0.95
     grad_clip: float = 1.0  # clip gradients at this value, or disable if == 0.0
+    use_8bit_adamw: bool = False  # 8-bit AdamW from bitsandbytes (cuda only)
     # learning rate decay settings
     decay_lr: bool = True  # whether to decay the learning rate
     warmup_iters: int = 1000  # how many steps to warm up for
@@ -66,8 +77,9 @@ class OptimizerConfig:
 @dataclass
 class SystemConfig:
     device: str = "mps:0"  # 'cpu', 'cuda', "mps"
-    dtype: str = "float16"  # float32|bfloat16|float16
+    dtype: str = "bfloat16"  # float32|bfloat16|float16
     compile: bool = False  # use PyTorch 2.0 to compile the model to be faster
+    grad_checkpoint: bool = False  # recompute block activations in the backward pass
 
 
 # logging
@@ -81,6 +93,11 @@ class WandbLog:
 # -----------------------------------------------------------------------------
 torch.backends.cuda.matmul.allow_tf32 = True  # allow tf32 on matmul
 torch.backends.cudnn.allow_tf32 = True  # allow tf32 on cudnn
+# allow reduced precision accumulation in fp16/bf16 matmuls
+torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = True
+torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+# prefer tf32/bf16 kernels for the remaining float32 matmuls
+torch.set_float32_matmul_precision("high")
 
 
 # -----------------------------------------------------------------------------
@@ -94,39 +111,174 @@ config = {k: globals()[k] for k in config_keys}  # will be useful for logging
 
 # -----------------------------------------------------------------------------
 # helps estimate an arbitrarily accurate loss over either split using many batches
-@torch.no_grad()
-def estimate_loss(model, iter_batches, eval_iters: int) -> Dict[str, float]:
+@torch.inference_mode()
+def estimate_loss(
+    model, eval_batches: Dict[str, List[Tuple[torch.Tensor, torch.Tensor]]]
+) -> Dict[str, float]:
     out = {}
     model.eval()
+    device = next(model.parameters()).device
     for split in ["train", "val"]:
-        batch_iter = iter_batches(split=split)
-        losses = torch.zeros(eval_iters)  # keep on CPU
-        for k in range(eval_iters):
-            X, Y = next(batch_iter)
+        # keep the losses on device to avoid a sync per eval iteration
+        losses = torch.zeros(len(eval_batches[split]), device=device)
+        for k, (X, Y) in enumerate(eval_batches[split]):
             with ctx:
-                _ = model(X, Y)
-                loss = raw_model.last_loss
-            losses[k] = loss.item()  # type: ignore
-        out[split] = losses.mean()
+                _, loss = model(X, Y)
+            losses[k] = loss.detach()  # type: ignore
+        out[split] = losses.mean().item()
     model.train()
     return out
 
 
-# learning rate decay scheduler (cosine with warmup)
-def get_lr(
-    it: int, warmup_iters: int, lr_decay_iters: int, min_lr: float, learning_rate: float
-) -> float:
+# whether torch.autocast supports the device type in the installed PyTorch version
+def autocast_available(device_type: str) -> bool:
+    if hasattr(torch.amp, "is_autocast_available"):  # PyTorch >= 2.4
+        return torch.amp.is_autocast_available(device_type)
+    # older versions only support autocast on cuda and cpu (mps arrived in 2.5)
+    return device_type in {"cuda", "cpu"}
+
+
+# whether bfloat16 tensors can be computed on the device (on mps this needs a recent
+# PyTorch version and macOS 14+)
+def bf16_supported(device: str) -> bool:
+    if device.startswith("cuda"):
+        return torch.cuda.is_bf16_supported()
+    try:
+        x = torch.ones(2, 2, dtype=torch.bfloat16, device=device)
+        (x @ x).cpu()
+    except (RuntimeError, TypeError):
+        return False
+    return True
+
+
+# learning rate decay scheduler (cosine with warmup), precomputed for every iteration
+def get_lr_schedule(
+    max_iters: int,
+    warmup_iters: int,
+    lr_decay_iters: int,
+    min_lr: float,
+    learning_rate: float,
+) -> np.ndarray:
+    it = np.arange(max_iters + 1)
+    # 3) after lr_decay_iters, keep the min learning rate
+    lr_schedule = np.full(max_iters + 1, min_lr, dtype=np.float64)
     # 1) linear warmup for warmup_iters steps
-    if it < warmup_iters:
-        return learning_rate * it / warmup_iters
-    # 2) if it > lr_decay_iters, return min learning rate
-    if it > lr_decay_iters:
-        return min_lr
-    # 3) in between, use cosine decay down to min learning rate
-    decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters)
-    assert 0 <= decay_ratio <= 1
-    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))  # coeff ranges 0..1
-    return min_lr + coeff * (learning_rate - min_lr)
+    warmup = it < warmup_iters
+    lr_schedule[warmup] = learning_rate * it[warmup] / warmup_iters
+    # 2) in between, use cosine decay down to min learning rate
+    decay = (it >= warmup_iters) & (it <= lr_decay_iters)
+    decay_ratio = (it[decay] - warmup_iters) / (lr_decay_iters - warmup_iters)
+    coeff = 0.5 * (1.0 + np.cos(np.pi * decay_ratio))  # coeff ranges 0..1
+    lr_schedule[decay] = min_lr + coeff * (learning_rate - min_lr)
+    return lr_schedule
+
+
+# activation checkpointing: only the inputs of each transformer block are kept in
+# memory, the attention + MLP activations are recomputed during the backward pass.
+# The embedding and output head are left untouched since they hold params, not
+# activations. Patching forward keeps the state_dict keys unchanged.
+def apply_activation_checkpointing(model: Transformer) -> None:
+    for layer in model.layers:
+        layer.forward = partial(
+            torch.utils.checkpoint.checkpoint, layer.forward, use_reentrant=False
+        )
+
+
+# global norm gradient clipping, using the multi-tensor (foreach) kernels to avoid
+# a kernel launch per parameter tensor
+def clip_grad_norm(parameters: Iterator[torch.Tensor], max_norm: float) -> torch.Tensor:
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return torch.tensor(0.0)
+    norms = torch._foreach_norm(grads, 2.0)
+    total_norm = torch.linalg.vector_norm(torch.stack(norms), 2.0)
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    torch._foreach_mul_(grads, clip_coef)
+    return total_norm
+
+
+# binary search of the largest batch size (among the sorted candidates) for which a
+# forward + backward pass fits in a fraction of the GPU memory. The probe runs on the
+# uncompiled model outside DDP, so the remaining memory is kept as headroom for the
+# CUDA graph memory pools (--compile) and the DDP gradient buckets
+def find_max_batch_size(
+    model: Transformer,
+    candidates: List[int],
+    context_length: int,
+    device: str,
+    memory_fraction: float = 0.8,
+) -> int:
+    total_memory = torch.cuda.get_device_properties(device).total_memory
+    memory_budget = memory_fraction * total_memory
+    # reserve the memory the AdamW moments will take after the first optimizer step
+    moments = [torch.empty_like(p) for p in model.parameters() for _ in range(2)]
+    best = candidates[0]
+    low, high = 0, len(candidates) - 1
+    while low <= high:
+        mid = (low + high) // 2
+        tokens, loss = None, None
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            tokens = torch.randint(
+                model.vocab_size, (candidates[mid], context_length + 1), device=device
+            )
+            with ctx:
+                _, loss = model(tokens[:, :-1], tokens[:, 1:])
+            loss.backward()  # type: ignore
+            fits = torch.cuda.max_memory_allocated(device) <= memory_budget
+        except torch.cuda.OutOfMemoryError:
+            fits = False
+        finally:
+            del tokens, loss
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+        if fits:
+            best = candidates[mid]
+            low = mid + 1
+        else:
+            high = mid - 1
+    del moments
+    torch.cuda.empty_cache()
+    return best
+
+
+# copy a (nested) state dict to CPU so it can be serialized in the background while
+# the training keeps updating the tensors on device
+def state_dict_to_cpu(state: Any) -> Any:
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: state_dict_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_dict_to_cpu(v) for v in state)
+    return state
+
+
+def log_to_wandb(payload: Dict[str, float], step: int) -> None:
+    try:
+        wandb.log(payload, step=step)
+    except Exception as e:
+        log.info(f"logging to wandb failed: {e}")
+
+
+# double-buffered prefetching: the next batch is copied to the device on a side
+# cuda stream (from pinned memory) while the current micro step is computing
+def cuda_prefetch(
+    batch_iter: Iterator[Tuple[torch.Tensor, torch.Tensor]], device: str
+) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    copy_stream = torch.cuda.Stream(device=device)
+    with torch.cuda.stream(copy_stream):
+        next_batch = next(batch_iter)
+    while True:
+        compute_stream = torch.cuda.current_stream(device)
+        compute_stream.wait_stream(copy_stream)
+        X, Y = next_batch
+        # tell the caching allocator these tensors are used on the compute stream
+        X.record_stream(compute_stream)
+        Y.record_stream(compute_stream)
+        with torch.cuda.stream(copy_stream):
+            next_batch = next(batch_iter)
+        yield X, Y
 
 
 # -----------------------------------------------------------------------------
@@ -176,21 +328,83 @@ if __name__ == "__main__":
     else:
         save_name = "ckpt"
 
+    # -----------------------------------------------------------------------------
+    # distributed data parallel: torchrun sets WORLD_SIZE, RANK and LOCAL_RANK
+    ddp = "WORLD_SIZE" in os.environ
+    if ddp:
+        dist.init_process_group(backend="nccl")
+        ddp_rank = int(os.environ["RANK"])
+        ddp_local_rank = int(os.environ["LOCAL_RANK"])
+        ddp_world_size = int(os.environ["WORLD_SIZE"])
+        args.system_config.device = f"cuda:{ddp_local_rank}"
+        torch.cuda.set_device(args.system_config.device)
+        # each process does a share of the gradient accumulation steps
+        if args.batch_config.gradient_accumulation_steps % ddp_world_size != 0:
+            raise ValueError(
+                "--gradient_accumulation_steps "
+                f"({args.batch_config.gradient_accumulation_steps}) must be a "
+                f"multiple of WORLD_SIZE ({ddp_world_size}) when training with DDP"
+            )
+        args.batch_config.gradient_accumulation_steps //= ddp_world_size
+    else:
+        ddp_rank = 0
+        ddp_world_size = 1
+    master_process = ddp_rank == 0  # logging, evaluation and checkpointing
+
+    # bfloat16 needs no GradScaler. If the device lacks it, fall back to float16 on
+    # cuda (with the GradScaler) and to float32 elsewhere since the GradScaler is
+    # cuda-only
+    if args.system_config.dtype == "bfloat16" and not bf16_supported(
+        args.system_config.device
+    ):
+        fallback_dtype = (
+            "float16" if args.system_config.device.startswith("cuda") else "float32"
+        )
+        log.warning(
+            f"bfloat16 is not supported on {args.system_config.device}, "
+            f"falling back to {fallback_dtype}"
+        )
+        args.system_config.dtype = fallback_dtype
+
     ptdtype = {
         "float32": torch.float32,
         "bfloat16": torch.bfloat16,
         "float16": torch.float16,
     }[args.system_config.dtype]
+    # strip the device index (e.g. "mps:0" -> "mps") to get the autocast device type
+    device_type = args.system_config.device.split(":")[0]
+    use_autocast = ptdtype != torch.float32
+    if use_autocast and not autocast_available(device_type):
+        log.warning(
+            f"autocast is not supported on {device_type} with this PyTorch version, "
+            "running in float32"
+        )
+        use_autocast = False
     ctx = (
-        nullcontext()
-        if args.system_config.device != "cuda"
-        else torch.amp.autocast(device_type=args.system_config.device, dtype=ptdtype)
+        torch.autocast(device_type=device_type, dtype=ptdtype)
+        if use_autocast
+        else nullcontext()
     )
+    # restrict scaled_dot_product_attention to the fused FlashAttention and
+    # memory-efficient kernels, with the math kernel as last resort
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+
+        attn_ctx = partial(
+            sdpa_kernel,
+            [
+                SDPBackend.FLASH_ATTENTION,
+                SDPBackend.EFFICIENT_ATTENTION,
+                SDPBackend.MATH,
+            ],
+        )
+    except ImportError:  # requires PyTorch >= 2.3
+        attn_ctx = nullcontext
 
     # -----------------------------------------------------------------------------
     # Weight & Biases logging
     # logging
-    if args.wandb_log.wandb_log:
+    if args.wandb_log.wandb_log and master_process:
         wandb.init(
             project=args.wandb_log.wandb_project,
             name=args.wandb_log.wandb_run_name,
@@ -203,23 +417,39 @@ if __name__ == "__main__":
         args.optimizer_config.max_iters
     )  # should be ~= max_iters per Chinchilla
     min_lr = 0.0  # minimum learning rate, should be ~= learning_rate/10 per Chinchilla
+    lr_schedule = (
+        get_lr_schedule(
+            max_iters=args.optimizer_config.max_iters,
+            warmup_iters=args.optimizer_config.warmup_iters,
+            lr_decay_iters=lr_decay_iters,
+            min_lr=min_lr,
+            learning_rate=args.optimizer_config.learning_rate,
+        )
+        if args.optimizer_config.decay_lr
+        else np.full(
+            args.optimizer_config.max_iters + 1, args.optimizer_config.learning_rate
+        )
+    )
 
     # -----------------------------------------------------------------------------
     tokens_per_iter = (
-        args.batch_config.gradient_accumulation_steps
+        ddp_world_size
+        * args.batch_config.gradient_accumulation_steps  # noqa
         * args.batch_config.batch_size  # noqa
         * args.model_config.max_context_length  # noqa
     )
     log.info(f"tokens per iteration will be: {tokens_per_iter:,}")
     log.info(
         f"""breaks down as:
+            > {ddp_world_size} processes *
             > {args.batch_config.gradient_accumulation_steps} grad accum steps  *
             >  {args.batch_config.batch_size} batch size *
             >  {args.model_config.max_context_length} context length"""
     )
-    args.eval_config.out_dir.mkdir(exist_ok=True)
+    if master_process:
+        args.eval_config.out_dir.mkdir(exist_ok=True)
     # -----------------------------------------------------------------------------
-    torch.manual_seed(1337 + args.batch_config.seed_offset)
+    torch.manual_seed(1337 + args.batch_config.seed_offset + ddp_rank)
 
     # -----------------------------------------------------------------------------
     if args.eval_config.init_weights == "random":
@@ -266,21 +496,111 @@ if __name__ == "__main__":
 
     model.to(args.system_config.device)
 
+    if args.system_config.grad_checkpoint:
+        log.info("using activation checkpointing on the transformer blocks")
+        apply_activation_checkpointing(model)
+
+    # keep an uncompiled, unwrapped handle on the Transformer for its attributes
+    # (configure_optimizer, estimate_mfu...), state_dict and export
+    raw_model = model
+
     # compile the model
     if args.system_config.compile:
         log.info("compiling the model... (takes a ~minute)")
-        unoptimized_model = model
-        model = torch.compile(model)  # requires PyTorch 2.0
-
-    optimizer = model.configure_optimizer(
-        args.optimizer_config.weight_decay,
-        args.optimizer_config.learning_rate,
-        (args.optimizer_config.beta1, args.optimizer_config.beta2),
-        args.system_config.device,
+        # reduce-overhead replays the compiled step as a CUDA graph (static shapes)
+        compile_mode = "reduce-overhead" if device_type == "cuda" else "default"
+        import torch._inductor.config as inductor_config
+
+        inductor_config.triton.cudagraphs = compile_mode == "reduce-overhead"
+        model = torch.compile(
+            model, mode=compile_mode, fullgraph=False, dynamic=False
+        )  # requires PyTorch 2.0
+
+    # compiled (if requested) but not DDP wrapped: evaluation only runs on the master
+    # process, where DDP collectives would hang
+    eval_model = model
+
+    # wrap the model into a DDP container
+    if ddp:
+        model = DistributedDataParallel(
+            model,
+            device_ids=[ddp_local_rank],
+            gradient_as_bucket_view=True,
+            static_graph=True,
+        )
+
+    optimizer = raw_model.configure_optimizer(
+        learning_rate=args.optimizer_config.learning_rate,
+        weight_decay=args.optimizer_config.weight_decay,
+        betas=(args.optimizer_config.beta1, args.optimizer_config.beta2),
+        device_type=args.system_config.device,
+        use_8bit=args.optimizer_config.use_8bit_adamw,
     )
+    # the precomputed schedule is applied as a multiplier of the max learning rate
+    lr_factors = lr_schedule / args.optimizer_config.learning_rate
+    scheduler = LambdaLR(
+        optimizer, lr_lambda=lambda it: lr_factors[min(it, len(lr_factors) - 1)]
+    )
+    if iter_num > 0:
+        # resuming the pretraining, restore the optimizer moments and lr schedule
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        if "scheduler" in checkpoint:
+            scheduler.load_state_dict(checkpoint["scheduler"])
+        else:
+            # older checkpoint: move the schedule to iter_num, updating both the
+            # scheduler's last lr and the optimizer param groups
+            scheduler.last_epoch = iter_num - 1
+            scheduler.step()
 
     # initialize a GradScaler. If enabled=False scaler is a no-op
-    scaler = torch.cuda.amp.GradScaler(enabled=(args.system_config.dtype == "float16"))
+    # (only needed for float16, and cuda-only, so it stays disabled on mps and cpu).
+    # Master weights and AdamW moments stay in float32, autocast only affects the
+    # activations.
+    scaler = torch.cuda.amp.GradScaler(
+        enabled=(args.system_config.dtype == "float16" and device_type == "cuda")
+    )
+
+    # replace gradient accumulation by a bigger micro-batch if it fits in memory.
+    # Only divisors of the effective batch size are tried, so tokens per iteration
+    # stay the same.
+    if args.batch_config.auto_batch and device_type == "cuda":
+        effective_batch_size = (
+            args.batch_config.batch_size * args.batch_config.gradient_accumulation_steps
+        )
+        batch_size = find_max_batch_size(
+            raw_model,
+            candidates=[
+                b
+                for b in range(args.batch_config.batch_size, effective_batch_size + 1)
+                if effective_batch_size % b == 0
+            ],
+            context_length=args.model_config.max_context_length,
+            device=args.system_config.device,
+        )
+        if ddp:  # all processes must agree on the batch size
+            batch_size_tensor = torch.tensor(
+                batch_size, device=args.system_config.device
+            )
+            dist.all_reduce(batch_size_tensor, op=dist.ReduceOp.MIN)
+            batch_size = int(batch_size_tensor.item())
+        args.batch_config.batch_size = batch_size
+        args.batch_config.gradient_accumulation_steps = (
+            effective_batch_size // batch_size
+        )
+        log.info(
+            "auto batch size",
+            batch_size=args.batch_config.batch_size,
+            gradient_accumulation_steps=args.batch_config.gradient_accumulation_steps,
+        )
+        if args.wandb_log.wandb_log and master_process:
+            wandb.config.update(
+                {
+                    "batch_size": args.batch_config.batch_size,
+                    "gradient_accumulation_steps": (
+                        args.batch_config.gradient_accumulation_steps
+                    ),
+                }
+            )
 
     # -----------------------------------------------------------------------------
     # Dataloader
@@ -316,45 +636,58 @@ if __name__ == "__main__":
             num_workers=args.batch_config.num_workers,
             **batch_params,
         )
+    # fixed evaluation set, drawn once and kept on device so that every eval
+    # reuses the same batches without going through the dataloader again
+    eval_batches = {}
+    if master_process:
+        for split in ["train", "val"]:
+            batch_iter = iter_batches(split=split)
+            eval_batches[split] = [
+                next(batch_iter) for _ in range(args.eval_config.eval_iters)
+            ]
+            batch_iter.close()  # shut down the dataloader workers
+
     # training
     train_batch_iter = iter_batches(split="train")
+    if device_type == "cuda":
+        train_batch_iter = cuda_prefetch(train_batch_iter, args.system_config.device)
     X, Y = next(train_batch_iter)  # fetch the very first batch
+    # CUDA graphs (compile mode="reduce-overhead") require static batch shapes
+    assert X.shape == (
+        args.batch_config.batch_size,
+        args.model_config.max_context_length,
+    ), f"unexpected batch shape {tuple(X.shape)}"
+    # background thread for checkpoint writes and wandb logging, so the training loop
+    # does not stall on disk or network
+    io_pool = ThreadPoolExecutor(max_workers=1)
+    atexit.register(io_pool.shutdown, wait=True)
+    save_future: Optional[Future] = None  # pending checkpoint write
+
     t0 = time.time()
+    # loss summed on device over the iterations since the last log step
+    loss_running = torch.zeros((), device=args.system_config.device)
+    log_iters = 0
     local_iter_num = 0  # number of iterations in the lifetime of this process
-    raw_model = model
     running_mfu = -1.0
 
     # training loop
     while True:
         # determine and set the learning rate for this iteration
-        lr = (
-            get_lr(
-                it=iter_num,
-                warmup_iters=args.optimizer_config.warmup_iters,
-                lr_decay_iters=lr_decay_iters,
-                min_lr=min_lr,
-                learning_rate=args.optimizer_config.learning_rate,
-            )
-            if args.optimizer_config.decay_lr
-            else args.optimizer_config.learning_rate
-        )
-        for param_group in optimizer.param_groups:
-            param_group["lr"] = lr
+        lr = scheduler.get_last_lr()[0]
 
         # evaluate the loss on train/val sets and write checkpoints
-        if iter_num % args.eval_config.eval_interval == 0:
-            losses = estimate_loss(
-                model=model,
-                iter_batches=iter_batches,
-                eval_iters=args.eval_config.eval_iters,
-            )
+        # (only on the master process, with the model not wrapped by DDP)
+        if iter_num % args.eval_config.eval_interval == 0 and master_process:
+            losses = estimate_loss(model=eval_model, eval_batches=eval_batches)
             log.info(
                 f"Step {iter_num}",
                 train_loss=f"{losses['train']:.4f}",
                 val_loss=f"{losses['val']:.4f}",
             )
-            try:
-                wandb.log(
+            # drop the log rather than lagging behind if the io thread is busy
+            if io_pool._work_queue.qsize() < 2:
+                io_pool.submit(
+                    log_to_wandb,
                     {
                         "iter": iter_num,
                         "tokens": iter_num * tokens_per_iter,
@@ -365,21 +698,23 @@ if __name__ == "__main__":
                     },
                     step=iter_num,
                 )
-            except Exception as e:
-                log.info(f"logging to wandb failed: {e}")
             if losses["val"] < best_val_loss or args.eval_config.always_save_checkpoint:
                 best_val_loss = losses["val"]
                 if iter_num > 0:
                     checkpoint = {
-                        "model": raw_model.state_dict(),
-                        "optimizer": optimizer.state_dict(),
+                        "model": state_dict_to_cpu(raw_model.state_dict()),
+                        "optimizer": state_dict_to_cpu(optimizer.state_dict()),
+                        "scheduler": scheduler.state_dict(),
                         "model_args": args.model_config,
                         "iter_num": iter_num,
                         "best_val_loss": best_val_loss,
                         "config": config,
                     }
                     log.info(f"saving checkpoint to {args.eval_config.out_dir}")
-                    torch.save(
+                    if save_future is not None:
+                        save_future.result()  # raises if the previous write failed
+                    save_future = io_pool.submit(
+                        torch.save,
                         checkpoint,
                         os.path.join(args.eval_config.out_dir, f"{save_name}.pt"),
                     )
@@ -390,54 +725,67 @@ if __name__ == "__main__":
                     )
 
         # forward backward update, with optional gradient accumulation
-
+        # (set_to_none skips zeroing the grads, but under DDP with
+        # gradient_as_bucket_view the grads are views into the buckets: nulling them
+        # would make the reducer allocate and copy them back every step, so they are
+        # zeroed in place instead)
+        optimizer.zero_grad(set_to_none=not ddp)
         for micro_step in range(args.batch_config.gradient_accumulation_steps):
-            with ctx:
-                logits = model(X, Y)
-                loss = raw_model.last_loss
-                loss = (
-                    loss / args.batch_config.gradient_accumulation_steps
-                )  # type: ignore
-            X, Y = next(train_batch_iter)  # fetch the next batch asynchrounously
-            scaler.scale(loss).backward()  # type: ignore
+            # in DDP, only all-reduce the gradients on the last micro step
+            last_micro_step = (
+                micro_step == args.batch_config.gradient_accumulation_steps - 1
+            )
+            sync_ctx = (
+                nullcontext()
+                if last_micro_step or not isinstance(model, DistributedDataParallel)
+                else model.no_sync()
+            )
+            with sync_ctx, attn_ctx():
+                with ctx:
+                    logits, loss = model(X, Y)
+                    loss = (
+                        loss / args.batch_config.gradient_accumulation_steps
+                    )  # type: ignore
+                X, Y = next(train_batch_iter)  # fetch the next batch asynchrounously
+                scaler.scale(loss).backward()  # type: ignore
+            loss_running += loss.detach()  # type: ignore
         # clip the gradient
         if args.optimizer_config.grad_clip != 0.0:
             scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(
-                model.parameters(), args.optimizer_config.grad_clip
-            )
+            clip_grad_norm(model.parameters(), args.optimizer_config.grad_clip)
         # step the optimizer and scaler if training in fp16
         scaler.step(optimizer)
         scaler.update()
-        # flush the gradients as soon as we can, no need for this memory anymore
-        optimizer.zero_grad(set_to_none=True)
+        # set the learning rate for the next iteration
+        scheduler.step()
 
-        # timing and logging
-        t1 = time.time()
-        dt = t1 - t0
-        t0 = t1
+        # timing and logging, only sync with the device on log steps
+        log_iters += 1
         if iter_num % args.eval_config.log_interval == 0:
-            lossf = (
-                loss.item()
-                * args.batch_config.gradient_accumulation_steps  # type: ignore # noqa
-            )
-            if local_iter_num >= 5:  # let the training loop settle a bit
-                mfu = raw_model.estimate_mfu(
-                    args.batch_config.batch_size
-                    * args.batch_config.gradient_accumulation_steps,  # noqa
-                    dt,
-                    flops_promised=2.6e12,
-                )
-                running_mfu = (
-                    mfu if running_mfu == -1.0 else 0.9 * running_mfu + 0.1 * mfu
+            if master_process:
+                # .item() waits for the device, so the wall clock time is accurate
+                lossf = loss_running.item() / log_iters
+                dt = (time.time() - t0) / log_iters
+                if local_iter_num >= 5:  # let the training loop settle a bit
+                    mfu = raw_model.estimate_mfu(
+                        args.batch_config.batch_size
+                        * args.batch_config.gradient_accumulation_steps,  # noqa
+                        dt,
+                        flops_promised=2.6e12,
+                    )
+                    running_mfu = (
+                        mfu if running_mfu == -1.0 else 0.9 * running_mfu + 0.1 * mfu
+                    )
+                log.info(
+                    f"Step {iter_num}",
+                    loss=f"{lossf:.4f}",
+                    lr=f"{lr:e}",
+                    ms=f"{dt*1000:.2f}",
+                    mfu=f"{running_mfu*100:.2f}%",
                 )
-            log.info(
-                f"Step {iter_num}",
-                loss=f"{lossf:.4f}",
-                lr=f"{lr:e}",
-                ms=f"{dt*1000:.2f}",
-                mfu=f"{running_mfu*100:.2f}%",
-            )
+            t0 = time.time()
+            loss_running.zero_()
+            log_iters = 0
         iter_num += 1
         local_iter_num += 1
 
@@ -445,37 +793,46 @@ if __name__ == "__main__":
         if iter_num > args.optimizer_config.max_iters:
             break
 
-    model.eval()
+    # make sure the last checkpoint was written
+    if save_future is not None:
+        save_future.result()
 
-    # load the tokenizer
-    tokenizer_model_path = f"climateGPT/models/tok{args.model_config.vocab_size}.model"
-    enc = Tokenizer(tokenizer_model_path=Path(tokenizer_model_path))
+    if ddp:
+        dist.destroy_process_group()
 
-    num_samples = 1  # number of samples to draw
-    max_new_tokens = 100  # number of tokens generated in each sample
-    temperature = (
-        1.0  # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
-    )
-    top_k = 300  # retain only the top_k most likely tokens, clamp others to have 0
-    # probability
-    tokenizer = ""  # override the tokenizer model path
-    seed = 1337
-
-    # encode the beginning of the prompt
-    start_ids = enc.encode("Climate change is", bos=True, eos=False)
-    x = torch.tensor(start_ids, dtype=torch.long, device=args.system_config.device)[
-        None, ...
-    ]
-
-    log.info("Run sample generation...")
-    # run generation
-    with torch.no_grad():
-        with ctx:
-            for k in range(num_samples):
-                y = model.generate(
-                    x, max_new_tokens, temperature=temperature, top_k=top_k
-                )
-                log.info(enc.decode(y[0].tolist()))
+    if master_process:
+        raw_model.eval()
+
+        # load the tokenizer
+        tokenizer_model_path = (
+            f"climateGPT/models/tok{args.model_config.vocab_size}.model"
+        )
+        enc = Tokenizer(tokenizer_model_path=Path(tokenizer_model_path))
+
+        num_samples = 1  # number of samples to draw
+        max_new_tokens = 100  # number of tokens generated in each sample
+        # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
+        temperature = 1.0
+        # retain only the top_k most likely tokens, clamp others to have 0 probability
+        top_k = 300
+        tokenizer = ""  # override the tokenizer model path
+        seed = 1337
+
+        # encode the beginning of the prompt
+        start_ids = enc.encode("Climate change is", bos=True, eos=False)
+        x = torch.tensor(start_ids, dtype=torch.long, device=args.system_config.device)[
+            None, ...
+        ]
+
+        log.info("Run sample generation...")
+        # run generation
+        with torch.no_grad():
+            with ctx:
+                for k in range(num_samples):
+                    y = raw_model.generate(
+                        x, max_new_tokens, temperature=temperature, top_k=top_k
+                    )
+                    log.info(enc.decode(y[0].tolist()))
 
 # TODO: add MoE layer and training loop
 
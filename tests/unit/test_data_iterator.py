@@ -22,5 +22,6 @@ class TestTokenIterator:
         )
 
         x, y = next(iter_batches)
+        assert x.dtype == torch.int32 and y.dtype == torch.int32
         assert (x == torch.tensor([[259, 13, 29934, 5921, 2, 1]])).all()
         assert (y == torch.tensor([[13, 29934, 5921, 2, 1, 450]])).all()
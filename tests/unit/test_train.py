@@ -0,0 +1,57 @@
+import math
+
+import pytest
+import torch
+
+from climateGPT.train import clip_grad_norm, get_lr_schedule
+
+
+# scalar cosine with warmup schedule the precomputed array replaces
+def get_lr(
+    it: int, warmup_iters: int, lr_decay_iters: int, min_lr: float, learning_rate: float
+) -> float:
+    if it < warmup_iters:
+        return learning_rate * it / warmup_iters
+    if it > lr_decay_iters:
+        return min_lr
+    decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters)
+    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))
+    return min_lr + coeff * (learning_rate - min_lr)
+
+
+class TestGetLrSchedule:
+    def test_matches_scalar_schedule(self):
+        schedule_params = {
+            "warmup_iters": 10,
+            "lr_decay_iters": 80,
+            "min_lr": 5e-5,
+            "learning_rate": 5e-4,
+        }
+        lr_schedule = get_lr_schedule(max_iters=100, **schedule_params)
+
+        assert lr_schedule.shape == (101,)
+        # warmup, warmup boundary, mid-decay, end of decay and constant tail
+        for it in [0, 5, 9, 10, 11, 45, 79, 80, 81, 100]:
+            assert lr_schedule[it] == pytest.approx(get_lr(it, **schedule_params))
+
+
+class TestClipGradNorm:
+    @staticmethod
+    def module_with_grads() -> torch.nn.Module:
+        torch.manual_seed(1337)
+        module = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+        module(torch.randn(3, 8)).pow(2).sum().backward()
+        return module
+
+    @pytest.mark.parametrize("max_norm", [0.01, 1e3])  # clipped and untouched
+    def test_matches_torch_clip_grad_norm(self, max_norm):
+        expected_module = self.module_with_grads()
+        expected_norm = torch.nn.utils.clip_grad_norm_(
+            expected_module.parameters(), max_norm
+        )
+        module = self.module_with_grads()
+        total_norm = clip_grad_norm(module.parameters(), max_norm)
+
+        assert torch.allclose(total_norm, expected_norm)
+        for p, expected_p in zip(module.parameters(), expected_module.parameters()):
+            assert torch.allclose(p.grad, expected_p.grad)